@@ -23,7 +23,8 @@ sqs = boto3.resource('sqs')
 queue = sqs.get_queue_by_name(QueueName=queueName)
 
 SUCCESFUL_STATUS = "Execution Successful"
-ACCEPTED_FORMATS = ['image/jpeg', 'image/png', 'application/pdf', 'audio/mp3']
+ACCEPTED_FORMATS = {'image/jpeg': 'jpeg', 'image/png': 'png', 'image/tiff': 'tiff', 'image/bmp': 'bmp', 'image/gif': 'gif', 'image/webp': 'webp',
+                    'application/pdf': 'pdf', 'audio/mp3': 'mp3'}
 
 def lambda_handler(event, context):
 
@@ -75,7 +76,7 @@ def push_to_queue(bucket, keys, document):
         print(f"Pushing document ID {document['id']} with filename {document['filename__v']} to SQS")
         message = {}
         message['documentId'] = document['id']
-        message['fileType'] = 'png'
+        message['fileType'] = ACCEPTED_FORMATS[document['format__v']]
         message['bucketName'] = bucket
         message['keyName'] = document_key
 
@@ -11,11 +11,14 @@
 import sys
 import os
 import json
+import time
 from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import decimal
 import boto3
 import requests
+from requests.adapters import HTTPAdapter
 
 sys.path.insert(0, '/opt')
 sm_client = boto3.client('secretsmanager')
@@ -26,13 +29,21 @@ VEEVA_USERNAME = sm_client.get_secret_value(SecretId = unquote_plus(os.environ['
 VEEVA_PASSWORD = sm_client.get_secret_value(SecretId = unquote_plus(os.environ['VEEVA_DOMAIN_PASSWORD_SECRET']))['SecretString']
 CUSTOM_PROPERTY_LABEL = sm_client.get_secret_value(SecretId = unquote_plus(os.environ['VEEVA_CUSTOM_FIELD_NAME_SECRET']))['SecretString']
 
-VERSION = 'v20.1'
+# the vault registry is a JSON list of additional vaults, each routed by the S3 location prefix or AppFlow flow name of the document.
+# [{"name": "...", "domainName": "...", "username": "...", "password": "...", "customFieldName": "...",
+#   "locationPrefixes": ["bucket/prefix/"], "flowNames": ["flow-name"], "maxRequestsPerSecond": 5}]
+if 'VEEVA_VAULT_REGISTRY_SECRET' in os.environ:
+    VAULT_REGISTRY = json.loads(sm_client.get_secret_value(SecretId = unquote_plus(os.environ['VEEVA_VAULT_REGISTRY_SECRET']))['SecretString'])
+else:
+    VAULT_REGISTRY = []
 
-# Veeva URL formats.
-auth_url = f'https://{VEEVA_DOMAIN_NAME}.veevavault.com/api/{VERSION}/auth'
-data_url = f'https://{VEEVA_DOMAIN_NAME}.veevavault.com/api/{VERSION}/'
-document_properties_url = f'https://{VEEVA_DOMAIN_NAME}.veevavault.com/api/{VERSION}/metadata/objects/documents/properties'
-document_url = f'https://{VEEVA_DOMAIN_NAME}.veevavault.com/api/{VERSION}/objects/documents/'
+VERSION = 'v20.1'
+DEFAULT_VAULT_NAME = 'default'
+DEFAULT_MAX_REQUESTS_PER_SECOND = 5
+REQUEST_TIMEOUT_SECONDS = 30
+# Veeva sessions time out after inactivity, re-authenticate once a session has been idle this long.
+# sessions Veeva invalidates sooner are detected by their INVALID_SESSION_ID response.
+SESSION_TTL_SECONDS = 15 * 60
 
 s3 = boto3.client('s3')
 sqs = boto3.resource('sqs')
@@ -42,96 +53,218 @@ sqs = boto3.resource('sqs')
 # we use this date to get all the changes for the first run and then just the delta.
 runDate = datetime.datetime(1900, 1, 1) 
 
+def create_vault(name, domain_name, username, password, custom_property_label,
+                 location_prefixes = None, flow_names = None, max_requests_per_second = DEFAULT_MAX_REQUESTS_PER_SECOND):
+    # every vault keeps its own HTTP connection pool, Veeva session and request rate.
+    # a vault is served by a single worker thread, so one kept-alive connection is enough.
+    http = requests.Session()
+    http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+    return {
+            'name': name,
+            'username': username,
+            'password': password,
+            'custom_property_label': custom_property_label,
+            'location_prefixes': location_prefixes or [],
+            'flow_names': flow_names or [],
+            # Veeva URL formats.
+            'auth_url': f'https://{domain_name}.veevavault.com/api/{VERSION}/auth',
+            'data_url': f'https://{domain_name}.veevavault.com/api/{VERSION}/',
+            'document_properties_url': f'https://{domain_name}.veevavault.com/api/{VERSION}/metadata/objects/documents/properties',
+            'document_url': f'https://{domain_name}.veevavault.com/api/{VERSION}/objects/documents/',
+            'http': http,
+            'request_interval': 1.0 / max_requests_per_second,
+            'next_request_time': 0.0,
+            'session_id': None,
+            'session_time': 0.0,
+            'custom_field_name': None
+    }
+
+# vaults are created when the Lambda environment is initialized, so sessions and connections are reused across invocations.
+VAULTS = {}
+for vault_config in VAULT_REGISTRY:
+    # a clashing name would silently send the routes of one vault to another
+    if vault_config['name'] == DEFAULT_VAULT_NAME or vault_config['name'] in VAULTS:
+        raise Exception(f"Vault registry entry name {vault_config['name']} is reserved or already in use.")
+    VAULTS[vault_config['name']] = create_vault(vault_config['name'],
+                                                vault_config['domainName'],
+                                                vault_config['username'],
+                                                vault_config['password'],
+                                                vault_config['customFieldName'],
+                                                vault_config.get('locationPrefixes'),
+                                                vault_config.get('flowNames'),
+                                                vault_config.get('maxRequestsPerSecond', DEFAULT_MAX_REQUESTS_PER_SECOND))
+# the vault configured by the stack parameters receives every record no other vault claims.
+VAULTS[DEFAULT_VAULT_NAME] = create_vault(DEFAULT_VAULT_NAME, VEEVA_DOMAIN_NAME, VEEVA_USERNAME, VEEVA_PASSWORD, CUSTOM_PROPERTY_LABEL)
+
 def lambda_handler(event, context):
+    vault_records = route_records(event['Records'])
+
+    # process the vaults in parallel, records of a single vault are processed in order.
+    if len(vault_records) > 0:
+        with ThreadPoolExecutor(max_workers=len(vault_records)) as executor:
+            results = executor.map(lambda vault_name: process_vault(VAULTS[vault_name], vault_records[vault_name]), vault_records.keys())
+            # surface any exception so the failed batch goes to the dead letter queue
+            list(results)
+
+    return 1
+
+def route_records(records):
+    vault_records = {}
+    for record in records:
+        if record['eventName'] == 'REMOVE':
+            continue
+        location = record['dynamodb']['NewImage']['Location']['S']
+        vault_name = get_vault_name(location)
+        if vault_name not in vault_records:
+            vault_records[vault_name] = []
+        vault_records[vault_name].append(record)
+    return vault_records
+
+def get_vault_name(location):
+    # location is bucket/prefix/flow-name/yyyy/mm/dd/hh/execution-id/...
+    location_parts = location.split('/')
+    flow_name = location_parts[2] if len(location_parts) > 2 else None
+    for vault in VAULTS.values():
+        if any(location.startswith(prefix) for prefix in vault['location_prefixes']) or flow_name in vault['flow_names']:
+            return vault['name']
+    return DEFAULT_VAULT_NAME
+
+def process_vault(vault, records):
     # attempt authentication with Veeva
     # https://developer.veevavault.com/api/20.1/#authentication
-    response = requests.post(auth_url,  data = {'username':VEEVA_USERNAME, 'password': VEEVA_PASSWORD})
-    response = response.json()
+    # failures raise, so the batch goes to the dead letter queue instead of losing the tags
+    if get_auth_header(vault) is None:
+        raise Exception(f"Authentication NOT Successful for vault {vault['name']}.")
 
-    if response['responseStatus'] == 'SUCCESS':
-        print ('Authentication Successful.')
-        session_id = response['sessionId']
+    label = vault['custom_property_label']
+    if custom_property_exists(vault, label):
+        push_tags(vault, records, label)
+    elif vault['name'] != DEFAULT_VAULT_NAME:
+        # a registry vault was configured for this field, so a missing field is a misconfiguration
+        raise Exception(f"Custom field {label} does not exist in vault {vault['name']}.")
+    else:
+        print (f"Custom field {label} does not exist in vault {vault['name']}. Skipping.")
 
-        #authHeader would be needed for subsequent calls. 
-        auth_header = {'Authorization': session_id}
+def get_auth_header(vault):
+    # reuse the cached session of the vault while it has been used recently
+    if vault['session_id'] is None or time.time() - vault['session_time'] > SESSION_TTL_SECONDS:
+        response = vault_request(vault, 'post', vault['auth_url'], data = {'username':vault['username'], 'password': vault['password']})
+        response = response.json()
 
-        if custom_property_exists(CUSTOM_PROPERTY_LABEL, auth_header):
-            push_tags(event, CUSTOM_PROPERTY_LABEL, auth_header)
-        else:
-            print (f'Custom field {CUSTOM_PROPERTY_LABEL} does not exist. Skipping.')
+        if response['responseStatus'] != 'SUCCESS':
+            print (f"Authentication NOT Successful for vault {vault['name']}.")
+            print (json.dumps(response))
+            return None
 
-    else:
-        print ('Authentication NOT Successful.')
-        print (json.dumps(response))
+        print (f"Authentication Successful for vault {vault['name']}.")
+        vault['session_id'] = response['sessionId']
+        vault['session_time'] = time.time()
+        vault['custom_field_name'] = None
 
-    return 1
+    #authHeader would be needed for subsequent calls. 
+    return {'Authorization': vault['session_id']}
+
+def veeva_request(vault, method, url, **kwargs):
+    # call the Veeva API with the cached session, authenticating again once if Veeva rejected it
+    for attempt in range(2):
+        auth_header = get_auth_header(vault)
+        if auth_header is None:
+            raise Exception(f"Authentication NOT Successful for vault {vault['name']}.")
+
+        response = vault_request(vault, method, url, headers=auth_header, **kwargs).json()
+        if not is_invalid_session(response):
+            # Veeva counts the session timeout from the last call
+            vault['session_time'] = time.time()
+            return response
+
+        print (f"Session of vault {vault['name']} is no longer valid. Authenticating again.")
+        vault['session_id'] = None
+        vault['custom_field_name'] = None
+    return response
+
+def is_invalid_session(response):
+    if response['responseStatus'] == 'SUCCESS':
+        return False
+    return any(error.get('type') == 'INVALID_SESSION_ID' for error in response.get('errors', []))
+
+def vault_request(vault, method, url, **kwargs):
+    # space the calls to a vault to stay within its rate limit.
+    # the limit applies per Lambda execution environment, concurrent invocations each apply their own.
+    now = time.monotonic()
+    wait = vault['next_request_time'] - now
+    vault['next_request_time'] = max(now, vault['next_request_time']) + vault['request_interval']
+    if wait > 0:
+        time.sleep(wait)
+    return vault['http'].request(method, url, timeout=REQUEST_TIMEOUT_SECONDS, **kwargs)
 
-def push_tags(event, label, auth_header):
+def push_tags(vault, records, label):
 
     tag_dictionary = {}
     count = 0
 
-    for record in event['Records']:
+    for record in records:
         print(record)
         # Get the primary key for use as the Elasticsearch ID
-        if record['eventName'] != 'REMOVE':
-            document_id = record['dynamodb']['NewImage']['DocumentId']['N']
-            if document_id not in tag_dictionary:
-                tag_dictionary[document_id] = set()
-            tag = record['dynamodb']['NewImage']['Tag']['S']
-            confidence = decimal.Decimal(record['dynamodb']['NewImage']['Confidence']['N'])
-            if confidence > 85:
-                if 'Value' in record['dynamodb']['NewImage'].keys() :
-                    value = record['dynamodb']['NewImage']['Value']['S']
-                    if value != 'False':
-                        tag_dictionary[document_id].add(tag + ':' + value)
-                else:
-                    tag_dictionary[document_id].add(tag)
+        document_id = record['dynamodb']['NewImage']['DocumentId']['N']
+        if document_id not in tag_dictionary:
+            tag_dictionary[document_id] = set()
+        tag = record['dynamodb']['NewImage']['Tag']['S']
+        confidence = decimal.Decimal(record['dynamodb']['NewImage']['Confidence']['N'])
+        if confidence > 85:
+            if 'Value' in record['dynamodb']['NewImage'].keys() :
+                value = record['dynamodb']['NewImage']['Value']['S']
+                if value != 'False':
+                    tag_dictionary[document_id].add(tag + ':' + value)
+            else:
+                tag_dictionary[document_id].add(tag)
         count += 1
 
     print(tag_dictionary)
 
+    custom_field_name = get_custom_field_name_based_on_label(vault, label)
     for (document_id, old_tags) in tag_dictionary.items():
-        document = get_document(document_id, auth_header)
-        custom_field_name = get_custom_field_name_based_on_label(label,auth_header)
+        document = get_document(vault, document_id)
         if custom_field_name in document:
             current_tags = set(document[custom_field_name].split(','))
         else:
             current_tags = set()
         new_tags = old_tags.union(current_tags)
-        update_document(document_id, label, ','.join(new_tags), auth_header)
+        update_document(vault, document_id, label, ','.join(new_tags))
 
-    print(str(count) + ' records processed.')
+    print(f"{count} records processed for vault {vault['name']}.")
 
-def custom_property_exists(label, auth_header):
-    labels = list(map(lambda x:x['label'],get_properties(auth_header)))
+def custom_property_exists(vault, label):
+    labels = list(map(lambda x:x['label'],get_properties(vault)))
     if label in labels:
         return True
     return False
 
-def get_custom_field_name_based_on_label(label, auth_header):
-    filtered_labels = list(filter(lambda x: 'label' in x.keys() and x['label']==label, get_properties(auth_header)))
+def get_custom_field_name_based_on_label(vault, label):
+    # the field name is resolved once per vault session
+    if vault['custom_field_name'] is not None:
+        return vault['custom_field_name']
+    filtered_labels = list(filter(lambda x: 'label' in x.keys() and x['label']==label, get_properties(vault)))
     if len(filtered_labels)!=0:
-        return filtered_labels[0]['name']
+        vault['custom_field_name'] = filtered_labels[0]['name']
+        return vault['custom_field_name']
     else: 
         raise Exception('Custom label is not present.')
 
-def get_properties(auth_header):
-    veeva_document_properties = requests.get(document_properties_url, headers=auth_header)
-    veeva_document_properties = veeva_document_properties.json()
+def get_properties(vault):
+    veeva_document_properties = veeva_request(vault, 'get', vault['document_properties_url'])
     if veeva_document_properties['responseStatus'] == 'SUCCESS':
         return list(filter(lambda x: 'label' in x.keys(), veeva_document_properties['properties']))
-    return []
+    # a failed call must not be reported as a missing custom field
+    raise Exception(f"Could not read the document properties of vault {vault['name']}: {json.dumps(veeva_document_properties)}")
 
-def get_document(document_id, auth_header):
-    veeva_document_response = requests.get(document_url + document_id, headers=auth_header)
-    veeva_document_response = veeva_document_response.json()
+def get_document(vault, document_id):
+    veeva_document_response = veeva_request(vault, 'get', vault['document_url'] + document_id)
     if veeva_document_response['responseStatus'] == 'SUCCESS':
         return veeva_document_response['document']
 
-def update_document(document_id, field_label, field_value, auth_header):
-    field_name = get_custom_field_name_based_on_label(field_label, auth_header)
+def update_document(vault, document_id, field_label, field_value):
+    field_name = get_custom_field_name_based_on_label(vault, field_label)
     data = { field_name: field_value}
-    veeva_document_update_response = requests.put(document_url + document_id, data= data, headers=auth_header)
-    veeva_document_update_response = veeva_document_update_response.json()
+    veeva_document_update_response = veeva_request(vault, 'put', vault['document_url'] + document_id, data= data)
     return veeva_document_update_response
@@ -58,6 +58,15 @@ INDEX_BODY = {
         "Value": {
             "type": "keyword"
         },
+        "Audio_Start_Time": {
+            "type": "float"
+        },
+        "Audio_End_Time": {
+            "type": "float"
+        },
+        "Speaker_Label": {
+            "type": "keyword"
+        },
         "TimeStamp": {
             "type": "date"
         }
@@ -94,6 +103,11 @@ def lambda_handler(event, context):
                 item['Face_Id'] = int(document['Face_Id']['N'])
             if 'Value' in document:
                 item['Value'] = document['Value']['S']
+            if 'Audio_Start_Time' in document:
+                item['Audio_Start_Time'] = float(document['Audio_Start_Time']['N'])
+                item['Audio_End_Time'] = float(document['Audio_End_Time']['N'])
+            if 'Speaker_Label' in document:
+                item['Speaker_Label'] = document['Speaker_Label']['S']
             item['Location'] = document['Location']['S']
             # print(json.dumps(item))
             requests.put(DOC_URL + es_id, auth=awsauth, json=item, headers=HEADERS)
@@ -14,10 +14,13 @@ import uuid
 import decimal
 import time
 import os
+import io
+from bisect import bisect_right
 from urllib.parse import unquote_plus
 import boto3
 
 sys.path.insert(0, '/opt')
+from PIL import Image, ImageOps
 
 # read the environment variables
 QUEUE_NAME = unquote_plus(os.environ['QUEUE_NAME'])
@@ -35,6 +38,27 @@ s3 = boto3.resource('s3')
 
 table = dynamoDBResource.Table(DDB_TABLE)
 
+# comprehend medical has a input size limit of 20,000 characters.
+COMPREHEND_MEDICAL_MAX_CHARS = 20000
+# once a transcript segment is this large, it is closed at the next sentence end.
+TRANSCRIPT_SEGMENT_SOFT_CHARS = 18000
+SENTENCE_END_PUNCTUATION = ('.', '?', '!')
+MAX_SPEAKER_LABELS = 10
+
+# rekognition accepts images up to 15 MB by S3 reference and up to 5 MB as raw bytes.
+REKOGNITION_MAX_S3_IMAGE_BYTES = 15 * 1024 * 1024
+REKOGNITION_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_IMAGE_DIMENSION = 4096
+# largest source image decoded in memory, about 200 MB as an RGB bitmap on the 1024 MB function.
+MAX_IMAGE_PIXELS = 64 * 1024 * 1024
+# largest source object downloaded for pre-processing, leaving room in the 1024 MB function for the decoded bitmap.
+MAX_PREPROCESS_SOURCE_BYTES = 100 * 1024 * 1024
+JPEG_QUALITY_STEPS = [90, 80, 70, 60, 50]
+IMAGE_HEADER_BYTES = 8
+SUPPORTED_IMAGE_HEADERS = [b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n']
+# Pillow refuses to open images over twice this limit instead of exhausting the function memory.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
 
 def lambda_handler(event, context):
 
@@ -64,7 +88,13 @@ def lambda_handler(event, context):
             try:
                 if (message_body['keyName'].lower().endswith('.jpg') 
                         or message_body['keyName'].lower().endswith('.jpeg') 
-                        or message_body['keyName'].lower().endswith('.png')):
+                        or message_body['keyName'].lower().endswith('.png')
+                        or message_body['keyName'].lower().endswith('.tif')
+                        or message_body['keyName'].lower().endswith('.tiff')
+                        or message_body['keyName'].lower().endswith('.bmp')
+                        or message_body['keyName'].lower().endswith('.gif')
+                        or message_body['keyName'].lower().endswith('.webp')):
+                    # Rekognition reads JPEG and PNG only, other formats are converted in pre-processing.
                     # Process the image.
                     process_image(message_body)
 
@@ -125,7 +155,11 @@ def process_audio(message_body):
                     Media={
                                 'MediaFileUri': f's3://{bucket_name}/{key_name}'
                             },
-                    OutputBucketName = bucket_name
+                    OutputBucketName = bucket_name,
+                    Settings = {
+                                'ShowSpeakerLabels': True,
+                                'MaxSpeakerLabels': MAX_SPEAKER_LABELS
+                            }
                     )
 
         transcribe_response = None
@@ -153,16 +187,17 @@ def process_audio(message_body):
                 print ('Text extracted from audio. Proceeding to extract clinical entities from the text...')
                 target_key_name = s3_location.split('/')[2]
                 print(target_key_name)
-                # get the text
+                # read the transcript segments straight off the S3 stream
                 bucket = s3.Bucket(bucket_name)
-                file_text = bucket.Object(target_key_name).get()['Body'].read().decode("utf-8", 'ignore')
+                transcript_body = bucket.Object(target_key_name).get()['Body']
+                segments = list(read_transcript_segments(transcript_body))
                 # delete the transcribe output
                 print ('Deleting transcribe output')
                 bucket.Object(target_key_name).delete()
-                # Use the extracted file text and process it using Comprehend Medical
+                # Use the transcript segments and process them using Comprehend Medical
                 print ('Pushing transcript to Comprehend medical...')
-                if len(file_text) > 0 :
-                    process_document(message_body, file_text, 'Audio-file')
+                if len(segments) > 0 :
+                    process_transcript(message_body, segments)
                 else:
                     print('Warning: transcript is empty. Skipping file.')
             else:
@@ -231,8 +266,8 @@ def process_document(message_body, file_text, asset_type):
         # comprehend medical has a input size limit of 20,000 characters.
         # ideally, you should break it down in chunks of 20K characters and call them in a loop
         # For this PoC, we will just consider the first 20K characters.
-        if len(file_text) > 20000:
-            file_text = file_text[0:20000]
+        if len(file_text) > COMPREHEND_MEDICAL_MAX_CHARS:
+            file_text = file_text[0:COMPREHEND_MEDICAL_MAX_CHARS]
 
          # call detect_entities
         print('Calling detect_entities')
@@ -240,57 +275,141 @@ def process_document(message_body, file_text, asset_type):
         # Call the detect_entities API to extract the entities
         test_result = hera.detect_entities(Text = file_text)
 
-         # Create a list of entities
-        test_entities = test_result['Entities']
-
-        trait_list = []
-        attribute_list = []
-
         # batch writer for dyanmodb is efficient way to write multiple items.
         with table.batch_writer() as batch:
-            # Create a loop to iterate through the individual entities
-            for row in test_entities:
-                # Remove PHI from the extracted entites
-                if row['Category'] != "PERSONAL_IDENTIFIABLE_INFORMATION":
-
-                    # Create a loop to iterate through each key in a row 
-                    for key in row:
-
-                        # Create a list of traits
-                        if key == 'Traits':
-                            if len(row[key])>0:
-                                trait_list = []
-                                for r in row[key]:
-                                    trait_list.append(r['Name'])
-
-                        # Create a list of Attributes
-                        elif key == 'Attributes':
-                            attribute_list = []
-                            for r in row[key]:
-                                attribute_list.append(r['Type']+':'+r['Text'])
-
-                item = generate_base_item(message_body, asset_type = asset_type, operation='DETECT_ENTITIES')
-                item['Confidence'] = decimal.Decimal(row['Score']) * 100
-                item['Tag'] = row['Text']
-                item['Detect_Entities_Type']= row['Type']
-                item['Detect_Entities_Category'] = row['Category']
-                item['Detect_Entities_Trait_List']= str(trait_list)
-                item['Detect_Entities_Attribute_List']=str(attribute_list)
-                batch.put_item(Item=item)
+            put_entity_items(batch, message_body, test_result['Entities'], asset_type)
         print('Tags inserted in DynamoDB.')
 
+def process_transcript(message_body, segments):
+    # batch writer for dyanmodb is efficient way to write multiple items.
+    with table.batch_writer() as batch:
+        for segment in segments:
+            print(f"Calling detect_entities for transcript segment {segment['start_time']}s - {segment['end_time']}s")
+            test_result = hera.detect_entities(Text = segment['text'])
+            put_entity_items(batch, message_body, test_result['Entities'], 'Audio-file', segment)
+    print('Tags inserted in DynamoDB.')
+
+def put_entity_items(batch, message_body, entities, asset_type, segment = None):
+    trait_list = []
+    attribute_list = []
+
+    # Create a loop to iterate through the individual entities
+    for row in entities:
+        # Remove PHI from the extracted entites
+        if row['Category'] != "PERSONAL_IDENTIFIABLE_INFORMATION":
+
+            # Create a loop to iterate through each key in a row 
+            for key in row:
+
+                # Create a list of traits
+                if key == 'Traits':
+                    if len(row[key])>0:
+                        trait_list = []
+                        for r in row[key]:
+                            trait_list.append(r['Name'])
+
+                # Create a list of Attributes
+                elif key == 'Attributes':
+                    attribute_list = []
+                    for r in row[key]:
+                        attribute_list.append(r['Type']+':'+r['Text'])
+
+        item = generate_base_item(message_body, asset_type = asset_type, operation='DETECT_ENTITIES')
+        item['Confidence'] = decimal.Decimal(row['Score']) * 100
+        item['Tag'] = row['Text']
+        item['Detect_Entities_Type']= row['Type']
+        item['Detect_Entities_Category'] = row['Category']
+        item['Detect_Entities_Trait_List']= str(trait_list)
+        item['Detect_Entities_Attribute_List']=str(attribute_list)
+        if segment is not None:
+            # tag the entity with the audio time range it was spoken in
+            (start_time, end_time, speaker_label) = get_segment_time_range(segment, row['BeginOffset'], row['EndOffset'])
+            if start_time is not None:
+                item['Audio_Start_Time'] = decimal.Decimal(start_time)
+                item['Audio_End_Time'] = decimal.Decimal(end_time)
+            if speaker_label is not None:
+                item['Speaker_Label'] = speaker_label
+        batch.put_item(Item=item)
+
+def read_transcript_segments(transcript_body, max_chars = COMPREHEND_MEDICAL_MAX_CHARS):
+    # parse the Transcribe output directly from the stream and yield plain text
+    # segments of at most max_chars, each carrying its audio time range.
+    results = json.load(transcript_body)['results']
+
+    # map the start time of each word to the speaker who said it
+    speakers = {}
+    if 'speaker_labels' in results:
+        for speaker_segment in results['speaker_labels']['segments']:
+            for speaker_item in speaker_segment['items']:
+                speakers[speaker_item['start_time']] = speaker_item['speaker_label']
+
+    items = results.get('items', [])
+    if len(items) == 0:
+        # no per-word metadata, fall back to the plain transcript text
+        transcript = ' '.join(t['transcript'] for t in results.get('transcripts', [])).strip()
+        for index in range(0, len(transcript), max_chars):
+            segment = new_transcript_segment()
+            segment['text'] = transcript[index:index + max_chars]
+            yield close_transcript_segment(segment)
+        return
+
+    segment = new_transcript_segment()
+    for item in items:
+        content = item['alternatives'][0]['content']
+
+        if item['type'] == 'punctuation':
+            # punctuation is attached to the preceding word
+            if len(segment['text']) + len(content) > max_chars:
+                continue
+            segment['text'] += content
+            if len(segment['text']) >= TRANSCRIPT_SEGMENT_SOFT_CHARS and content in SENTENCE_END_PUNCTUATION:
+                yield close_transcript_segment(segment)
+                segment = new_transcript_segment()
+            continue
+
+        separator = ' ' if len(segment['text']) > 0 else ''
+        if len(segment['text']) + len(separator) + len(content) > max_chars:
+            yield close_transcript_segment(segment)
+            segment = new_transcript_segment()
+            separator = ''
+
+        begin_offset = len(segment['text']) + len(separator)
+        segment['text'] += separator + content
+        segment['words'].append((begin_offset, len(segment['text']), item['start_time'], item['end_time'], speakers.get(item['start_time'])))
+
+    if len(segment['text']) > 0:
+        yield close_transcript_segment(segment)
+
+def new_transcript_segment():
+    return {'text': '', 'start_time': None, 'end_time': None, 'words': [], 'offsets': []}
+
+def close_transcript_segment(segment):
+    if len(segment['words']) > 0:
+        segment['start_time'] = segment['words'][0][2]
+        segment['end_time'] = segment['words'][-1][3]
+    segment['offsets'] = [word[0] for word in segment['words']]
+    return segment
+
+def get_segment_time_range(segment, begin_offset, end_offset):
+    # find the words overlapping the [begin_offset, end_offset) character range
+    words = segment['words']
+    if len(words) == 0:
+        return (None, None, None)
+    first = max(bisect_right(segment['offsets'], begin_offset) - 1, 0)
+    last = first
+    while last + 1 < len(words) and words[last + 1][0] < end_offset:
+        last += 1
+    return (words[first][2], words[last][3], words[first][4])
+
 def process_image(message_body):
     if message_body is not None:
         print(f"Processing Image: {message_body['bucketName']}/{message_body['keyName']}")
+        # reference the image in S3, or pass pre-processed bytes if rekognition cannot read it as is
+        image = get_rekognition_image(message_body)
         # call detect_labels
         print('Calling detect_labels')
         response = rekognition.detect_labels(
-                            Image={
-                                'S3Object': {
-                                    'Bucket': message_body['bucketName'],
-                                    'Name': message_body['keyName']
-                                }
-                            }
+                            Image=image
                         )
 
         if_person = False
@@ -310,12 +429,7 @@ def process_image(message_body):
                 # call detect_faces
                 print('Calling detect_faces')
                 response = rekognition.detect_faces(
-                            Image={
-                                'S3Object': {
-                                    'Bucket': message_body['bucketName'],
-                                    'Name': message_body['keyName']
-                                }
-                            },
+                            Image=image,
                             Attributes=['ALL']
                         )
                 # print(json.dumps(response))
@@ -366,12 +480,7 @@ def process_image(message_body):
             # call detect_text
             print('Calling detect_text')
             response = rekognition.detect_text(
-                                    Image={
-                                        'S3Object': {
-                                            'Bucket': message_body['bucketName'],
-                                            'Name': message_body['keyName']
-                                        }
-                                    }
+                                    Image=image
                                 )
             # create data structure and insert in DDB
             for text in response['TextDetections']:
@@ -383,6 +492,61 @@ def process_image(message_body):
         print('Tags inserted in DynamoDB.')
         return 1
 
+def get_rekognition_image(message_body):
+    s3_object = s3.Object(message_body['bucketName'], message_body['keyName'])
+
+    # check the size and the file header before handing the object to rekognition.
+    # the ranged get returns both, the ContentRange is formatted as bytes 0-7/<size>
+    header_response = s3_object.get(Range=f'bytes=0-{IMAGE_HEADER_BYTES - 1}')
+    header = header_response['Body'].read()
+    image_size = int(header_response['ContentRange'].split('/')[1])
+    supported_format = any(header.startswith(h) for h in SUPPORTED_IMAGE_HEADERS)
+    if supported_format and image_size <= REKOGNITION_MAX_S3_IMAGE_BYTES:
+        return {
+                'S3Object': {
+                    'Bucket': message_body['bucketName'],
+                    'Name': message_body['keyName']
+                }
+            }
+
+    # refuse oversized sources before downloading them, so one asset cannot exhaust the function memory
+    if image_size > MAX_PREPROCESS_SOURCE_BYTES:
+        raise Exception(f'Image is {image_size} bytes, larger than the {MAX_PREPROCESS_SOURCE_BYTES} byte limit for pre-processing.')
+
+    print(f'Image is {image_size} bytes with header {header.hex()}. Pre-processing in memory.')
+    image_bytes = preprocess_image(s3_object.get()['Body'].read())
+    print(f'Image pre-processed to {len(image_bytes)} bytes.')
+    return {'Bytes': image_bytes}
+
+def preprocess_image(image_bytes):
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except Image.DecompressionBombError:
+        raise Exception(f'Image is larger than the {MAX_IMAGE_PIXELS} pixel limit for pre-processing.')
+
+    # let the JPEG decoder downscale while decoding
+    image.draft('RGB', (MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+    (width, height) = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise Exception(f'Image is {width}x{height} pixels, larger than the {MAX_IMAGE_PIXELS} pixel limit for pre-processing.')
+
+    # apply the EXIF orientation the way rekognition does for images it reads from S3,
+    # the re-encoded JPEG carries no EXIF data
+    image = ImageOps.exif_transpose(image)
+
+    # bound the resolution before converting, so only the reduced bitmap is copied
+    image.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+    image = image.convert('RGB')
+
+    # recompress as JPEG, lowering the quality until it fits the rekognition bytes limit
+    for quality in JPEG_QUALITY_STEPS:
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        if output.tell() <= REKOGNITION_MAX_IMAGE_BYTES:
+            return output.getvalue()
+
+    raise Exception('Image could not be reduced below the Rekognition size limit.')
+
 def generate_base_item(message_body, asset_type = None, operation = None):
     # time in milliseconds
     timestamp = int(round(time.time() * 1000))